@@ -4,8 +4,9 @@ Intel Hex Loader
 Intel Hexフォーマットのファイルを読み込み、解析、変換するためのライブラリ
 """
 
-import os
-import re
+import string
+from bisect import bisect_left
+from collections import Counter
 from typing import Dict, List, Tuple, Optional, Union
 from dataclasses import dataclass
 from enum import IntEnum
@@ -21,12 +22,21 @@ class RecordType(IntEnum):
     START_LINEAR_ADDR = 0x05      # スタートリニアアドレスレコード
 
 
+# レコードタイプの値から名前への変換表
+_RT_NAMES = {rt.value: rt.name for rt in RecordType}
+
+# 16進数として有効な文字（エラー内容の判定用）
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+
 @dataclass
 class HexRecord:
     """Intel Hexレコードを表すデータクラス"""
+    __slots__ = ('length', 'address', 'record_type', 'data', 'checksum', 'line_number')
+    
     length: int
     address: int
-    record_type: RecordType
+    record_type: int  # RecordTypeの値
     data: bytes
     checksum: int
     line_number: int
@@ -35,9 +45,19 @@ class HexRecord:
 class IntelHexLoader:
     """Intel Hexファイルのローダークラス"""
     
-    def __init__(self):
+    def __init__(self, retain_records: bool = False):
+        """
+        初期化
+        
+        Args:
+            retain_records: 解析したレコードをself.recordsに保持するか
+                （Falseの場合はレコードタイプ別の件数のみ集計する）
+        """
+        self.retain_records = retain_records
         self.records: List[HexRecord] = []
-        self.memory: Dict[int, int] = {}
+        self._type_counts: Counter = Counter()
+        # 連続したデータ領域のリスト [開始アドレス, データ]（開始アドレス順、隣接・重複なし）
+        self.segments: List[List[Union[int, bytearray]]] = []
         self.start_address: Optional[int] = None
         self.extended_linear_address: int = 0
         self.extended_segment_address: int = 0
@@ -53,10 +73,12 @@ class IntelHexLoader:
             FileNotFoundError: ファイルが存在しない場合
             ValueError: ファイルフォーマットが不正な場合
         """
-        if not os.path.exists(filepath):
+        try:
+            f = open(filepath, 'rb')
+        except FileNotFoundError:
             raise FileNotFoundError(f"ファイルが見つかりません: {filepath}")
             
-        with open(filepath, 'r') as f:
+        with f:
             self._parse_file(f)
             
     def load_string(self, hex_string: str) -> None:
@@ -70,21 +92,37 @@ class IntelHexLoader:
         self._parse_lines(lines)
         
     def _parse_file(self, file) -> None:
-        """ファイルオブジェクトから読み込み"""
-        lines = [line.strip() for line in file if line.strip()]
+        """ファイルオブジェクト（バイナリモード）から読み込み"""
+        # Intel HexはASCIIのみで構成されるため、ファイル全体を一度に読み込んでデコードする
+        data = file.read().decode('ascii', 'replace')
+        lines = [line for line in map(str.strip, data.splitlines()) if line]
         self._parse_lines(lines)
         
     def _parse_lines(self, lines: List[str]) -> None:
         """行のリストを解析"""
         self.records.clear()
-        self.memory.clear()
+        self._type_counts.clear()
+        self.segments.clear()
         self.extended_linear_address = 0
         self.extended_segment_address = 0
         
+        # レコードを保持する場合は、行数分のリストを先に確保する
+        retain_records = self.retain_records
+        if retain_records:
+            self.records = [None] * len(lines)
+            
+        # ループ内で使うメソッドをローカル変数に置き換える
+        parse_line = self._parse_line
+        process_record = self._process_record
+        records = self.records
+        type_counts = self._type_counts
+        
         for line_num, line in enumerate(lines, 1):
-            record = self._parse_line(line, line_num)
-            self.records.append(record)
-            self._process_record(record)
+            record = parse_line(line, line_num)
+            if retain_records:
+                records[line_num - 1] = record
+            type_counts[record.record_type] += 1
+            process_record(record)
             
     def _parse_line(self, line: str, line_number: int) -> HexRecord:
         """
@@ -108,33 +146,39 @@ class IntelHexLoader:
         if len(line) < 11:
             raise ValueError(f"行 {line_number}: 行が短すぎます")
             
-        # 16進数文字のみかチェック
-        hex_pattern = re.compile(r'^:[0-9A-Fa-f]+$')
-        if not hex_pattern.match(line):
+        # 16進数文字のみかチェック（行全体を一度にバイト列へ変換）
+        try:
+            raw = bytes.fromhex(line[1:])
+        except ValueError:
+            # 16進数文字だけで桁数が奇数の場合はデータ長の誤り
+            if _HEX_DIGITS.issuperset(line[1:]):
+                raise ValueError(f"行 {line_number}: データ長が不正です")
+            raise ValueError(f"行 {line_number}: 無効な文字が含まれています")
+        # bytes.fromhexは空白を読み飛ばすため、変換後の長さで空白の混入を検出
+        if len(raw) * 2 + 1 != len(line):
             raise ValueError(f"行 {line_number}: 無効な文字が含まれています")
             
         # フィールドの抽出
         try:
-            length = int(line[1:3], 16)
-            address = int(line[3:7], 16)
-            record_type = RecordType(int(line[7:9], 16))
+            length = raw[0]
+            address = (raw[1] << 8) | raw[2]
+            record_type = raw[3]
+            if record_type > RecordType.START_LINEAR_ADDR:
+                raise ValueError(f"{record_type} is not a valid RecordType")
             
-            # データ部分の抽出
-            data_end = 9 + (length * 2)
-            if len(line) < data_end + 2:
+            # データ長チェック（長さ + アドレス(2) + タイプ + データ + チェックサム）
+            if len(raw) != 5 + length:
                 raise ValueError(f"行 {line_number}: データ長が不正です")
                 
-            data_hex = line[9:data_end]
-            data = bytes.fromhex(data_hex)
-            
-            checksum = int(line[data_end:data_end + 2], 16)
+            data = raw[4:4 + length]
+            checksum = raw[4 + length]
             
         except ValueError as e:
             raise ValueError(f"行 {line_number}: 解析エラー - {str(e)}")
             
-        # チェックサムの検証
-        calculated_checksum = self._calculate_checksum(length, address, record_type, data)
-        if calculated_checksum != checksum:
+        # チェックサムの検証（チェックサムを含む全バイトの合計の下位8ビットが0になる）
+        if sum(raw) & 0xFF:
+            calculated_checksum = self._calculate_checksum(length, address, record_type, data)
             raise ValueError(
                 f"行 {line_number}: チェックサムエラー "
                 f"(期待値: {calculated_checksum:02X}, 実際: {checksum:02X})"
@@ -149,44 +193,103 @@ class IntelHexLoader:
             line_number=line_number
         )
         
-    def _calculate_checksum(self, length: int, address: int, record_type: RecordType, data: bytes) -> int:
+    def _calculate_checksum(self, length: int, address: int, record_type: int, data: bytes) -> int:
         """チェックサムを計算"""
-        sum_value = length
-        sum_value += (address >> 8) & 0xFF
-        sum_value += address & 0xFF
-        sum_value += record_type
-        sum_value += sum(data)
-        
-        # 2の補数を取る
-        checksum = (-sum_value) & 0xFF
-        return checksum
+        # 全バイトの合計の2の補数を取る
+        return (-(length + (address >> 8) + (address & 0xFF) + record_type + sum(data))) & 0xFF
         
     def _process_record(self, record: HexRecord) -> None:
         """レコードを処理してメモリに格納"""
-        if record.record_type == RecordType.DATA:
-            # データレコード
-            base_address = (self.extended_linear_address << 16) + self.extended_segment_address + record.address
-            for i, byte in enumerate(record.data):
-                self.memory[base_address + i] = byte
+        handler = self._RECORD_HANDLERS.get(record.record_type)
+        if handler is not None:
+            handler(self, record)
+            
+    def _process_data(self, record: HexRecord) -> None:
+        """データレコード"""
+        base_address = (self.extended_linear_address << 16) + self.extended_segment_address + record.address
+        if record.data:
+            self._store(base_address, record.data)
+            
+    def _process_ext_linear_addr(self, record: HexRecord) -> None:
+        """拡張リニアアドレス"""
+        if len(record.data) != 2:
+            raise ValueError(f"行 {record.line_number}: 拡張リニアアドレスレコードのデータ長が不正です")
+        self.extended_linear_address = (record.data[0] << 8) | record.data[1]
+        
+    def _process_ext_segment_addr(self, record: HexRecord) -> None:
+        """拡張セグメントアドレス"""
+        if len(record.data) != 2:
+            raise ValueError(f"行 {record.line_number}: 拡張セグメントアドレスレコードのデータ長が不正です")
+        self.extended_segment_address = ((record.data[0] << 8) | record.data[1]) << 4
+        
+    def _process_start_linear_addr(self, record: HexRecord) -> None:
+        """スタートリニアアドレス"""
+        if len(record.data) != 4:
+            raise ValueError(f"行 {record.line_number}: スタートリニアアドレスレコードのデータ長が不正です")
+        self.start_address = (record.data[0] << 24) | (record.data[1] << 16) | (record.data[2] << 8) | record.data[3]
+        
+    # レコードタイプ（整数値）ごとの処理
+    _RECORD_HANDLERS = {
+        RecordType.DATA: _process_data,
+        RecordType.EXT_LINEAR_ADDR: _process_ext_linear_addr,
+        RecordType.EXT_SEGMENT_ADDR: _process_ext_segment_addr,
+        RecordType.START_LINEAR_ADDR: _process_start_linear_addr,
+    }
+    
+    def _store(self, address: int, data: bytes) -> None:
+        """
+        データをセグメントリストに格納
+
+        隣接・重複するセグメントとは結合し、重複部分は後から書き込んだデータで上書きする
+        """
+        segments = self.segments
+        end = address + len(data)
+        
+        # アドレス順に並んだレコードは、最後のセグメントの延長か新しい領域になる
+        if segments:
+            last_start, last_buf = segments[-1]
+            last_end = last_start + len(last_buf)
+            if address == last_end:
+                last_buf += data
+                return
+            if address > last_end:
+                segments.append([address, bytearray(data)])
+                return
                 
-        elif record.record_type == RecordType.EXT_LINEAR_ADDR:
-            # 拡張リニアアドレス
-            if len(record.data) != 2:
-                raise ValueError(f"行 {record.line_number}: 拡張リニアアドレスレコードのデータ長が不正です")
-            self.extended_linear_address = (record.data[0] << 8) | record.data[1]
+        # 結合対象となるセグメントの範囲 [lo, hi) を求める
+        i = bisect_left(segments, [address])
+        lo = i
+        if i > 0:
+            prev_start, prev_buf = segments[i - 1]
+            if prev_start + len(prev_buf) >= address:
+                lo = i - 1
+        hi = i
+        while hi < len(segments) and segments[hi][0] <= end:
+            hi += 1
+            
+        if lo == hi:
+            # 結合対象なし: 新しいセグメントを挿入
+            segments.insert(i, [address, bytearray(data)])
+            return
             
-        elif record.record_type == RecordType.EXT_SEGMENT_ADDR:
-            # 拡張セグメントアドレス
-            if len(record.data) != 2:
-                raise ValueError(f"行 {record.line_number}: 拡張セグメントアドレスレコードのデータ長が不正です")
-            self.extended_segment_address = ((record.data[0] << 8) | record.data[1]) << 4
+        # 先頭のセグメントのバッファを再利用して結合
+        start = segments[lo][0]
+        if start <= address:
+            buf = segments[lo][1]
+            first = lo + 1
+        else:
+            start = address
+            buf = bytearray()
+            first = lo
             
-        elif record.record_type == RecordType.START_LINEAR_ADDR:
-            # スタートリニアアドレス
-            if len(record.data) != 4:
-                raise ValueError(f"行 {record.line_number}: スタートリニアアドレスレコードのデータ長が不正です")
-            self.start_address = (record.data[0] << 24) | (record.data[1] << 16) | (record.data[2] << 8) | record.data[3]
+        for seg_start, seg_buf in segments[first:hi] + [[address, data]]:
+            offset = seg_start - start
+            if offset > len(buf):
+                buf.extend(bytes(offset - len(buf)))
+            buf[offset:offset + len(seg_buf)] = seg_buf
             
+        segments[lo:hi] = [[start, buf]]
+        
     def to_binary(self, fill_byte: int = 0xFF, start_address: Optional[int] = None, 
                   end_address: Optional[int] = None) -> bytes:
         """
@@ -200,20 +303,46 @@ class IntelHexLoader:
         Returns:
             bytes: バイナリデータ
         """
-        if not self.memory:
+        if not self.segments:
             return b''
             
         # アドレス範囲の決定
-        min_addr = min(self.memory.keys()) if start_address is None else start_address
-        max_addr = max(self.memory.keys()) if end_address is None else end_address
-        
-        # バイナリデータの生成
-        binary_data = bytearray()
-        for addr in range(min_addr, max_addr + 1):
-            binary_data.append(self.memory.get(addr, fill_byte))
+        if start_address is None:
+            min_addr = self.segments[0][0]
+        else:
+            min_addr = start_address
+        if end_address is None:
+            last_start, last_buf = self.segments[-1]
+            max_addr = last_start + len(last_buf) - 1
+        else:
+            max_addr = end_address
+            
+        if max_addr < min_addr:
+            return b''
+            
+        # バイナリデータの生成（空き領域を埋めたバッファに各セグメントを書き込む）
+        # 範囲の先頭を含むセグメントから、範囲の終端を超えるまでをコピーする
+        binary_data = bytearray([fill_byte]) * (max_addr - min_addr + 1)
+        first = max(0, bisect_left(self.segments, [min_addr + 1]) - 1)
+        for seg_start, buf in self.segments[first:]:
+            if seg_start > max_addr:
+                break
+            lo = max(seg_start, min_addr)
+            hi = min(seg_start + len(buf), max_addr + 1)
+            if lo < hi:
+                binary_data[lo - min_addr:hi - min_addr] = memoryview(buf)[lo - seg_start:hi - seg_start]
             
         return bytes(binary_data)
         
+    def get_data_size(self) -> int:
+        """
+        読み込んだデータの総バイト数を取得
+        
+        Returns:
+            int: 全データ領域の合計バイト数
+        """
+        return sum(len(buf) for _, buf in self.segments)
+        
     def get_memory_map(self) -> List[Tuple[int, int]]:
         """
         メモリマップを取得（連続したデータ領域のリスト）
@@ -221,25 +350,7 @@ class IntelHexLoader:
         Returns:
             List[Tuple[int, int]]: (開始アドレス, 終了アドレス)のリスト
         """
-        if not self.memory:
-            return []
-            
-        sorted_addresses = sorted(self.memory.keys())
-        regions = []
-        region_start = sorted_addresses[0]
-        prev_addr = sorted_addresses[0]
-        
-        for addr in sorted_addresses[1:]:
-            if addr != prev_addr + 1:
-                # 不連続な領域
-                regions.append((region_start, prev_addr))
-                region_start = addr
-            prev_addr = addr
-            
-        # 最後の領域を追加
-        regions.append((region_start, prev_addr))
-        
-        return regions
+        return [(start, start + len(buf) - 1) for start, buf in self.segments]
         
     def print_memory_map(self) -> None:
         """メモリマップを表示"""
@@ -272,19 +383,17 @@ class IntelHexLoader:
         Returns:
             Dict: 統計情報を含む辞書
         """
+        # レコードタイプ別の集計（解析時に数えた件数を使う）
+        type_counts = self._type_counts
+        
         stats = {
-            'total_records': len(self.records),
-            'data_records': sum(1 for r in self.records if r.record_type == RecordType.DATA),
-            'total_bytes': len(self.memory),
-            'memory_regions': len(self.get_memory_map()),
-            'record_types': {}
+            'total_records': sum(type_counts.values()),
+            'data_records': type_counts.get(RecordType.DATA, 0),
+            'total_bytes': self.get_data_size(),
+            'memory_regions': len(self.segments),
+            'record_types': {_RT_NAMES[t]: n for t, n in type_counts.items()}
         }
         
-        # レコードタイプ別の集計
-        for record in self.records:
-            type_name = record.record_type.name
-            stats['record_types'][type_name] = stats['record_types'].get(type_name, 0) + 1
-            
         return stats
 
 
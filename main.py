@@ -4,10 +4,19 @@ CircuitPythonで動作し、USB CDC経由で受信したデータをGPIOに出
 標準入出力とは独立してUSBシリアルを使用するため、print()でのデバッグが可能
 """
 
+import array
 import board
 import digitalio
 import time
 import usb_cdc
+from microcontroller import delay_us
+
+try:
+    import rp2pio
+    import adafruit_pioasm
+except ImportError:
+    # PIOが使えない場合はdigitalioでGPIOを直接操作する
+    rp2pio = None
 
 # GPIO設定（CircuitPythonのboard定義を使用）
 ADDR_PINS = [board.GP0, board.GP1, board.GP2, board.GP3, 
@@ -17,9 +26,42 @@ DATA_PINS = [board.GP8, board.GP9, board.GP10, board.GP11,
 WE_PIN = board.GP16  # /WE (Write Enable) 信号 - Active Low
 LED_PIN = board.LED  # PICO内蔵LED
 
+# PIO設定
+# 1ワード = アドレス(bit0-7) | データ(bit8-15) | WEパルス幅のループ回数(bit16-31)
+# アドレス・データの出力から/WEパルスまでをPIOが一定のサイクル数で実行する
+PIO_FREQUENCY = 1000000  # 1サイクル = 1us
+PIO_LOOP_CYCLES = 16     # 待機ループ1回あたりのサイクル数
+WRITE_PROGRAM = """
+.program z80_write
+.side_set 1
+    pull block          side 1      ; 次のワードを待つ（/WE=High）
+    out pins, 16        side 1      ; アドレス(GP0-7)・データ(GP8-15)を出力
+    out y, 16           side 1      ; WEパルス幅のループ回数
+    set x, 31           side 1      ; 32回 × 32サイクル = 約1ms（GPIO版のdelay_us(1000)に合わせる）
+setup:
+    nop                 side 1 [15]
+    jmp x-- setup       side 1 [15] ; AddressとDataを設定した後に少しだけ待つ
+    mov x, y            side 0      ; /WE信号をLow（アクティブ）
+pulse_low:
+    jmp x-- pulse_low   side 0 [15] ; WEパルス幅
+    mov x, y            side 1      ; /WE信号をHigh（非アクティブ）
+pulse_high:
+    jmp x-- pulse_high  side 1 [15] ; 次の書き込みまでの待機時間
+    push block          side 1      ; 書き込み完了を通知
+"""
+BUS_RESET_PROGRAM = """
+.side_set 1
+    mov pins, null      side 1
+"""
+
 # デバッグモード
 DEBUG = True  # USB CDCを使うので、print()でのデバッグが可能
 
+# プロトコル設定
+# Writeコマンド: W:AAAAAAAA:LLLL:<hex>（アドレス32ビット、データ長16ビット）
+MAX_WRITE_LENGTH = 4096  # Writeコマンド1回あたりの最大データ長（バイト）
+MAX_LINE_LENGTH = MAX_WRITE_LENGTH * 2 + 32  # 受信する1行の最大長（最大長のWriteコマンドが収まる長さ）
+
 def error_led_blink(led_pin=LED_PIN, count=5, interval=1):
     """エラー時のLED点滅パターン（共通関数）"""
     led = digitalio.DigitalInOut(led_pin)
@@ -33,10 +75,8 @@ def error_led_blink(led_pin=LED_PIN, count=5, interval=1):
 class PicoHexLoader:
     def __init__(self):
         """GPIOとシリアル通信の初期化"""
-        # LEDの初期化
-        self.led = digitalio.DigitalInOut(LED_PIN)
-        self.led.direction = digitalio.Direction.OUTPUT
-        self.led.value = False  # LED消灯
+        # LEDの初期化（消灯）
+        self.led = self._out(LED_PIN, False)
         
         # Write Enable期間の設定（デフォルト: 0.3ms）
         self.we_pulse_ms = 0.3
@@ -57,59 +97,130 @@ class PicoHexLoader:
         # 受信バッファ
         self.rx_buffer = bytearray()
         
-        # アドレスバスの設定
-        self.addr_pins = []
-        for pin in ADDR_PINS:
-            p = digitalio.DigitalInOut(pin)
-            p.direction = digitalio.Direction.OUTPUT
-            p.value = False
-            self.addr_pins.append(p)
-        
-        # データバスの設定
-        self.data_pins = []
-        for pin in DATA_PINS:
-            p = digitalio.DigitalInOut(pin)
-            p.direction = digitalio.Direction.OUTPUT
-            p.value = False
-            self.data_pins.append(p)
-        
-        # /WE信号の設定（初期値はHigh = 非アクティブ）
-        self.we_pin = digitalio.DigitalInOut(WE_PIN)
-        self.we_pin.direction = digitalio.Direction.OUTPUT
-        self.we_pin.value = True
+        if rp2pio:
+            # PIOでアドレス・データの出力と/WEパルスを行う（Writeコマンド単位で_write_block_pioに渡す）
+            self._init_pio()
+        else:
+            self._init_gpio()
+            self.write_byte = self._make_write_byte_gpio(self.we_pulse_ms / 1000.0)
         
         if DEBUG:
             print("[DEBUG] GPIO and USB CDC initialized")
     
+    def _init_gpio(self):
+        """digitalioでアドレスバス・データバス・/WE信号を初期化"""
+        # アドレスバス・データバスの設定（初期値はLow）
+        self.addr_pins = [self._out(pin, False) for pin in ADDR_PINS]
+        self.data_pins = [self._out(pin, False) for pin in DATA_PINS]
+        
+        # /WE信号の設定（初期値はHigh = 非アクティブ）
+        self.we_pin = self._out(WE_PIN, True)
+    
+    @staticmethod
+    def _out(pin, value):
+        """出力ピンを初期値付きで作成"""
+        p = digitalio.DigitalInOut(pin)
+        p.switch_to_output(value=value)
+        return p
     
-    def write_byte(self, address, data):
-        """1バイトをGPIOに出力"""
+    def _init_pio(self):
+        """PIOのステートマシンを初期化（GP0-15: アドレス・データ、GP16: /WE）"""
+        self.sm = rp2pio.StateMachine(
+            adafruit_pioasm.assemble(WRITE_PROGRAM),
+            frequency=PIO_FREQUENCY,
+            first_out_pin=ADDR_PINS[0],
+            out_pin_count=16,
+            initial_out_pin_state=0,
+            initial_out_pin_direction=0xFFFF,
+            first_sideset_pin=WE_PIN,
+            sideset_pin_count=1,
+            initial_sideset_pin_state=1,
+            initial_sideset_pin_direction=1,
+        )
+        self._bus_reset = adafruit_pioasm.assemble(BUS_RESET_PROGRAM)
+        # 書き込みワードと完了通知の受信バッファ（Writeコマンドごとに確保しないよう、最大長で確保しておく）
+        self._pio_words = array.array('I', bytes(4 * MAX_WRITE_LENGTH))
+        self._pio_acks = array.array('I', bytes(4 * MAX_WRITE_LENGTH))
+        self._pulse_loops = self._pio_pulse_loops(self.we_pulse_ms)
+    
+    def _pio_pulse_loops(self, pulse_ms):
+        """WEパルス幅をPIOの待機ループ回数に変換"""
+        loops = round(pulse_ms * PIO_FREQUENCY / 1000 / PIO_LOOP_CYCLES)
+        return min(0xFFFF, max(0, loops - 1))
+    
+    def _write_block_pio(self, start_address, data):
+        """連続したアドレスへのデータをPIO経由でまとめて出力"""
+        pulse = self._pulse_loops << 16
+        words = self._pio_words
+        n = len(data)
+        for i in range(n):
+            words[i] = pulse | (data[i] << 8) | ((start_address + i) & 0xFF)  # 8ビットアドレスに制限
+        # 先頭n個のワードを送り、1ワードごとに返る完了通知をn個受け取る（すべての/WEパルスが終わるまで待つ）
+        self.sm.write_readinto(words, self._pio_acks, out_end=n, in_end=n)
+    
+    def _make_write_byte_gpio(self, pulse_s):
+        """
+        WEパルス幅を固定したGPIO出力関数を生成
         
-        # アドレスを設定
-        for i in range(8):
-            self.addr_pins[i].value = bool((address >> i) & 1)
+        パルス幅はTコマンドでしか変わらないため、その時点で関数を作り直す
+        """
+        # 属性参照をローカル変数（クロージャ）に置き換える
+        ap = self.addr_pins
+        dp = self.data_pins
+        we = self.we_pin
+        led = self.led
         
-        # データを設定
-        for i in range(8):
-            self.data_pins[i].value = bool((data >> i) & 1)
+        # 1ms未満のパルスはtime.sleepでは精度が出ないため、delay_usで待つ
+        if pulse_s < 0.001:
+            wait = delay_us
+            pulse = int(pulse_s * 1000000)
+        else:
+            wait = time.sleep
+            pulse = pulse_s
         
-        # WEを有効にする前にAddressとDataを設定した後に、ほんの少しだけ待つ
-        time.sleep(0.001)
+        def write_byte(address, data):
+            """1バイトをGPIOに出力"""
+            # アドレスを設定
+            ap[0].value = address & 0x01
+            ap[1].value = address & 0x02
+            ap[2].value = address & 0x04
+            ap[3].value = address & 0x08
+            ap[4].value = address & 0x10
+            ap[5].value = address & 0x20
+            ap[6].value = address & 0x40
+            ap[7].value = address & 0x80
+            
+            # データを設定
+            dp[0].value = data & 0x01
+            dp[1].value = data & 0x02
+            dp[2].value = data & 0x04
+            dp[3].value = data & 0x08
+            dp[4].value = data & 0x10
+            dp[5].value = data & 0x20
+            dp[6].value = data & 0x40
+            dp[7].value = data & 0x80
+            
+            # WEを有効にする前にAddressとDataを設定した後に、ほんの少しだけ待つ
+            # （書き込み中は他に処理することがないためビジーウェイトでも損はなく、
+            #   time.sleepの1ms刻みより正確に、PIO版の待機とホスト側の見積もり（1ms）に揃えられる）
+            delay_us(1000)
 
-        # /WE信号をLow（アクティブ）にして書き込み
-        # WEが有効な間は、LEDを点灯させる
-        self.led.value = True
-        self.we_pin.value = False
-        time.sleep(self.we_pulse_ms / 1000.0)  # WEパルス幅
-        self.led.value = False
-        
-        # /WE信号をHigh（非アクティブ）に戻す
-        self.we_pin.value = True
-        # 次の書き込みまでの待機時間
-        time.sleep(self.we_pulse_ms / 1000.0)  # WEパルス幅
+            # /WE信号をLow（アクティブ）にして書き込み
+            # WEが有効な間は、LEDを点灯させる
+            led.value = True
+            we.value = False
+            wait(pulse)  # WEパルス幅
+            led.value = False
+            
+            # /WE信号をHigh（非アクティブ）に戻す
+            we.value = True
+            # 次の書き込みまでの待機時間
+            wait(pulse)  # WEパルス幅
+            
+            if DEBUG:
+                print(f"[DEBUG] Write: ADDR=0x{address:02X}, DATA=0x{data:02X}, /WE=0 (active)")
         
-        if DEBUG:
-            print(f"[DEBUG] Write: ADDR=0x{address:02X}, DATA=0x{data:02X}, /WE=0 (active)")
+        return write_byte
     
     def parse_command(self, line):
         """コマンドを解析"""
@@ -150,21 +261,26 @@ class PicoHexLoader:
                 if len(parts) != 4:
                     return {'error': 'FORMAT', 'message': 'Invalid write format'}
                 
+                # アドレスは8桁、データ長は4桁の固定長（旧形式の2桁は受け付けない）
+                if len(parts[1]) != 8 or len(parts[2]) != 4:
+                    return {'error': 'FORMAT', 'message': 'Write address/length must be 8/4 hex digits'}
+                
                 start_address = int(parts[1], 16)
                 length = int(parts[2], 16)
                 hex_data = parts[3]
                 
                 # データ長チェック
-                if length == 0 or length > 255:
+                if length == 0 or length > MAX_WRITE_LENGTH:
                     return {'error': 'LENGTH', 'message': f'Invalid length: {length}'}
                 
                 if len(hex_data) != length * 2:
                     return {'error': 'LENGTH', 'message': f'Expected {length*2} hex chars, got {len(hex_data)}'}
                 
                 # 16進数文字列をバイト配列に変換
-                data = []
-                for i in range(0, len(hex_data), 2):
-                    data.append(int(hex_data[i:i+2], 16))
+                try:
+                    data = bytes.fromhex(hex_data)
+                except ValueError:
+                    return {'error': 'FORMAT', 'message': 'Invalid hex data'}
                 
                 return {
                     'cmd': 'W',
@@ -190,118 +306,164 @@ class PicoHexLoader:
         if DEBUG:
             print(f"[DEBUG] Write command: START_ADDR=0x{start_address:02X}, LENGTH={length}")
         
-        # 各バイトを書き込み
-        for i in range(length):
-            address = (start_address + i) & 0xFF  # 8ビットアドレスに制限
-            self.write_byte(address, data[i])
+        if rp2pio:
+            # レコード全体をまとめてPIOに渡す
+            self._write_block_pio(start_address, data)
             
             if DEBUG:
-                print(f"[DEBUG] Writing byte {i+1}/{length}: ADDR=0x{address:02X}, DATA=0x{data[i]:02X}")
+                for i in range(length):
+                    address = (start_address + i) & 0xFF
+                    print(f"[DEBUG] Writing byte {i+1}/{length}: ADDR=0x{address:02X}, DATA=0x{data[i]:02X}")
+        else:
+            # 各バイトを書き込み
+            for i in range(length):
+                address = (start_address + i) & 0xFF  # 8ビットアドレスに制限
+                self.write_byte(address, data[i])
+                
+                if DEBUG:
+                    print(f"[DEBUG] Writing byte {i+1}/{length}: ADDR=0x{address:02X}, DATA=0x{data[i]:02X}")
         
         self.send_response("OK", "WRITE")
     
-    def read_line(self):
-        """シリアルから1行読み込み（CRLF/LF対応）- ノンブロッキング"""
-        MAX_LINE_LENGTH = 1024  # 最大行長
-        
-        # 新しいデータを読み込み
-        data = self.serial.read()
-        if data:
-            self.rx_buffer.extend(data)
-        
-        # バッファサイズチェック
-        if len(self.rx_buffer) > MAX_LINE_LENGTH:
-            # 長すぎる行は破棄
-            self.rx_buffer = bytearray()
-            return None
+    def handle_timing_command(self, pulse_ms):
+        """Timingコマンドを処理"""
+        self.we_pulse_ms = pulse_ms
+        if rp2pio:
+            self._pulse_loops = self._pio_pulse_loops(pulse_ms)
+        else:
+            self.write_byte = self._make_write_byte_gpio(pulse_ms / 1000.0)
+        if DEBUG:
+            print(f"[DEBUG] Timing set: pulse={self.we_pulse_ms}ms")
+        self.send_response("OK", f"TIMING:{self.we_pulse_ms}")
+    
+    def reset_bus(self):
+        """アドレスバス・データバスをLow、/WE信号をHighに戻す"""
+        if rp2pio:
+            self.sm.run(self._bus_reset)
+            return
+        for pin in self.addr_pins + self.data_pins:
+            pin.value = False
+        self.we_pin.value = True
+    
+    def read_lines(self):
+        """シリアルから受信済みの行をすべて読み込み（CRLF/LF対応）- ノンブロッキング"""
+        # 受信済みのデータをまとめて読み込み
+        waiting = self.serial.in_waiting
+        if waiting:
+            self.rx_buffer.extend(self.serial.read(waiting))
         
-        # 改行文字を探す（\n or \r\n）
-        newline_pos = self.rx_buffer.find(b'\n')
-        if newline_pos >= 0:
-            # 改行までのデータを取得
-            line_data = self.rx_buffer[:newline_pos]
+        # 改行文字で区切って完全な行を取り出す（\n or \r\n）
+        rx_buffer = self.rx_buffer
+        lines = []
+        start = 0
+        newline_pos = rx_buffer.find(b'\n')
+        while newline_pos >= 0:
+            line_data = rx_buffer[start:newline_pos]
             # CRLFの場合、CRを削除
             if line_data.endswith(b'\r'):
                 line_data = line_data[:-1]
             
             try:
                 line = line_data.decode('utf-8')
+                if line:
+                    lines.append(line)
             except UnicodeDecodeError:
                 # デコードエラーは無視
-                self.rx_buffer = self.rx_buffer[newline_pos + 1:]
-                return None
+                pass
             
-            # バッファから削除
-            self.rx_buffer = self.rx_buffer[newline_pos + 1:]
-            return line
+            start = newline_pos + 1
+            newline_pos = rx_buffer.find(b'\n', start)
+        
+        # 取り出した行をバッファから削除
+        # （CircuitPythonのbytearrayはdelでの削除に対応していないため、スライス代入で詰める）
+        if start:
+            rx_buffer[:] = rx_buffer[start:]
+        
+        # バッファサイズチェック（改行のないまま長すぎる行は破棄）
+        if len(rx_buffer) > MAX_LINE_LENGTH:
+            self.rx_buffer = bytearray()
+        
+        return lines
+    
+    def process_command(self, line):
+        """1行分のコマンドを解析して実行"""
+        if DEBUG:
+            print(f"[DEBUG] Received: {line}")
+        
+        # コマンドを解析
+        result = self.parse_command(line)
         
-        # 完全な行がまだない
-        return None
+        if 'error' in result:
+            self.send_response("ERR", result['error'])
+            return
+        
+        cmd = result['cmd']
+        
+        # コマンドごとの処理
+        if cmd == 'P':
+            self.send_response("OK", "READY")
+        
+        elif cmd == 'T':
+            # タイミング設定
+            self.handle_timing_command(result['pulse_ms'])
+        
+        elif cmd == 'W':
+            self.handle_write_command(
+                result['start_address'],
+                result['length'],
+                result['data']
+            )
+        
+        elif cmd == 'E':
+            self.send_response("OK", "END")
+            # 必要に応じてGPIOをリセット
+            self.reset_bus()
     
     def run(self):
         """メインループ"""
         print("PICO Hex Loader (USB CDC) started")
         self.send_response("OK", "READY")
         
+        # ループ内で使う属性参照をローカル変数に置き換える
+        led = self.led
+        read_lines = self.read_lines
+        process_command = self.process_command
+        send_response = self.send_response
+        sleep = time.sleep
+        
         # 待機中はLEDを点灯
-        self.led.value = True
+        led.value = True
         
         while True:
+            # 待機中はLEDを点灯
+            led.value = True
+            
+            # 受信済みの行をまとめて読み込む（ノンブロッキング）
             try:
-                # 待機中はLEDを点灯
-                self.led.value = True
-                
-                # シリアルからの入力を読み込む（ノンブロッキング）
-                line = self.read_line()
-                if not line:
-                    # データがない場合は少し待つ
-                    time.sleep(0.01)
-                    continue
-                
-                # コマンドを受信したらLEDを消灯（処理中）
-                self.led.value = False
-                
-                if DEBUG:
-                    print(f"[DEBUG] Received: {line}")
-                
-                # コマンドを解析
-                result = self.parse_command(line)
-                
-                if 'error' in result:
-                    self.send_response("ERR", result['error'])
-                    continue
-                
-                cmd = result['cmd']
-                
-                # コマンドごとの処理
-                if cmd == 'P':
-                    self.send_response("OK", "READY")
-                
-                elif cmd == 'T':
-                    # タイミング設定
-                    self.we_pulse_ms = result['pulse_ms']
-                    if DEBUG:
-                        print(f"[DEBUG] Timing set: pulse={self.we_pulse_ms}ms")
-                    self.send_response("OK", f"TIMING:{self.we_pulse_ms}")
-                
-                elif cmd == 'W':
-                    self.handle_write_command(
-                        result['start_address'],
-                        result['length'],
-                        result['data']
-                    )
-                
-                elif cmd == 'E':
-                    self.send_response("OK", "END")
-                    # 必要に応じてGPIOをリセット
-                    for pin in self.addr_pins + self.data_pins:
-                        pin.value = False
-                    self.we_pin.value = True
-                
+                lines = read_lines()
             except Exception as e:
+                # 受信エラーの場合は受信バッファを捨てて処理を続ける
                 if DEBUG:
-                    print(f"[DEBUG] Error: {e}")
-                self.send_response("ERR", "FORMAT")
+                    print(f"[DEBUG] Read error: {e}")
+                self.rx_buffer = bytearray()
+                send_response("ERR", "FORMAT")
+                continue
+            if not lines:
+                # データがない場合は少し待つ
+                sleep(0.005)
+                continue
+            
+            # コマンドを受信したらLEDを消灯（処理中）
+            led.value = False
+            
+            # 受信した行をすべて処理してから次の読み込みに戻る
+            for line in lines:
+                try:
+                    process_command(line)
+                except Exception as e:
+                    if DEBUG:
+                        print(f"[DEBUG] Error: {e}")
+                    send_response("ERR", "FORMAT")
 
 
 # メイン実行
@@ -5,7 +5,10 @@ Intel Hexファイルを読み込み、USB CDC経由でPICOに転送する
 """
 
 import sys
+import binascii
+import math
 import time
+from collections import deque
 import serial
 import serial.tools.list_ports
 from pathlib import Path
@@ -15,13 +18,29 @@ sys.path.append(str(Path(__file__).parent.parent))
 from intel_hex_loader import IntelHexLoader
 
 # 定数
-DEFAULT_BAUDRATE = 115200
+DEFAULT_BAUDRATE = 1000000  # USB CDCでは実際の転送速度に影響しない
 RESPONSE_TIMEOUT = 5.0  # レスポンスタイムアウト（秒）
+MAX_PIPELINE_DEPTH = 4  # レスポンスを待たずに送信するコマンドの最大数
+WRITE_HEADER_FORMAT = b"W:%08X:%04X:"  # Writeコマンドのヘッダ（開始アドレス32ビット、データ長16ビット）
+MAX_CHUNK_SIZE = 4096  # Writeコマンド1回あたりの最大データ長（PICO側のMAX_WRITE_LENGTHと合わせる）
+PICO_HWID_PATTERN = r"VID:PID=(239A|2E8A):"  # PICOのポートを絞り込むhwidの正規表現
+PING_COMMAND = b"P\r\n"  # Pingコマンド
+END_COMMAND = b"E\r\n"  # 転送終了コマンド
+RESPONSE_OK = b"OK:"  # 成功レスポンスの先頭（成功時はparse_response()で解析しない）
+RESPONSE_READY = b"OK:READY"  # Pingの成功レスポンス
+MAX_RESPONSE_LENGTH = 128  # レスポンス1行の最大長（バイト）
+HANDSHAKE_TIMEOUT = 0.5  # 接続時のPing応答を待つ最大時間（秒）
+HANDSHAKE_READ_TIMEOUT = 0.1  # 接続時に1行を待つ時間（秒、経過したらPingを再送）
+PROGRESS_INTERVAL = 0.1  # 転送中の進捗表示の最小間隔（秒）
+DEFAULT_CDC_PACKET_SIZE = 64  # USB CDCのパケットサイズ（Full Speed: 64、High Speed: 512）
+BYTE_SETUP_MS = 1.0  # PICOがアドレス・データを設定してから/WEをLowにするまでの待機時間（ミリ秒）
+PICO_DEBUG_BYTE_MS = 10.0  # PICO側のDEBUG有効時の1バイトあたりのデバッグ出力時間（ミリ秒）
 
 class PicoSerialLoader:
     """PICOへのシリアル転送を管理するクラス"""
     
-    def __init__(self, port=None, baudrate=DEFAULT_BAUDRATE, debug=False):
+    def __init__(self, port=None, baudrate=DEFAULT_BAUDRATE, debug=False,
+                 cdc_packet_size=DEFAULT_CDC_PACKET_SIZE, pico_debug=True):
         """
         初期化
         
@@ -29,27 +48,38 @@ class PicoSerialLoader:
             port: シリアルポート名（Noneの場合は自動検出）
             baudrate: ボーレート
             debug: デバッグモード
+            cdc_packet_size: USB CDCのパケットサイズ（バイト）
+            pico_debug: PICO側（main.py）のDEBUGが有効か（1バイトあたりの処理時間の見積もりに使う）
         """
         self.port = port
         self.baudrate = baudrate
         self.debug = debug
+        self.cdc_packet_size = cdc_packet_size
+        self.pico_debug = pico_debug
         self.serial = None
         self.pulse_ms = 0.3  # デフォルトパルス幅（0.3ms）
         self.chunk_size = 128 # デフォルトのチャンクサイズ
+        self.window = 2  # レスポンスを待たずに送信するコマンド数
+        self.rtt_ms = 0.0  # Pingの往復時間（ミリ秒）
+        self.inflight = deque()  # レスポンス待ちのコマンド
+        self._scratch = bytearray(MAX_PIPELINE_DEPTH * len(self.build_write_command(0, bytes(self.chunk_size))))  # コマンド作業バッファ
         
     def find_pico_port(self):
         """PICOのデータポートを自動検出"""
-        ports = serial.tools.list_ports.comports()
+        # PICOのUSB VIDを持つポートだけに絞り込む
+        # MicroPython: 0x2E8A, CircuitPython: 0x239A (Adafruit)
+        ports = serial.tools.list_ports.grep(PICO_HWID_PATTERN)
         pico_ports = []
         micropython_found = False
         
         for port in ports:
-            # PICOのUSB VID/PIDをチェック
-            # MicroPython: 0x2E8A, CircuitPython: 0x239A (Adafruit)
             if port.vid == 0x239A:
                 pico_ports.append(port)
                 if self.debug:
                     print(f"[DEBUG] Found CircuitPython PICO: {port.device} - {port.description} (VID: 0x{port.vid:04X})")
+                # コンソールとデータの2ポートが見つかれば残りは調べない
+                if len(pico_ports) >= 2:
+                    break
             elif port.vid == 0x2E8A:
                 micropython_found = True
                 if self.debug:
@@ -95,17 +125,54 @@ class PicoSerialLoader:
                 bytesize=8,
                 parity='N',
                 stopbits=1,
-                timeout=1.0
+                timeout=HANDSHAKE_READ_TIMEOUT
             )
-            # バッファをクリア
-            self.serial.reset_input_buffer()
-            self.serial.reset_output_buffer()
+            
+            # 受信バッファに残った古いデータはPingの応答が来るまで読み捨てる
+            self._handshake()
             
             print(f"接続しました: {self.port} @ {self.baudrate}bps")
             
         except serial.SerialException as e:
             raise RuntimeError(f"シリアルポートの接続に失敗しました: {e}")
     
+    def _handshake(self):
+        """
+        受信済みのデータを読み捨ててからPingを1回だけ送り、OK:READYがちょうど1行だけ返るまで繰り返す
+        
+        起動時に送られるOK:READYや、遅れて届いた前回のPingの応答が残っていると、
+        以降のレスポンスが1行ずつずれるため、Pingと応答が1対1になったことを確認してから戻る
+        """
+        ser = self.serial
+        deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+        while True:
+            # 古い応答が途切れるまで読み捨てる
+            self._discard_input(deadline)
+            
+            ser.write(PING_COMMAND)
+            data = ser.read_until(b"\n", MAX_RESPONSE_LENGTH)
+            # 応答の後に別の行が続く場合は、どちらが今回のPingの応答か分からないためやり直す
+            extra = ser.read_until(b"\n", MAX_RESPONSE_LENGTH)
+            if data.strip() == RESPONSE_READY and not extra:
+                return
+            
+            if self.debug:
+                for line in (data + extra).splitlines():
+                    print(f"[DEBUG] Discarded: {line.decode(errors='replace')}")
+            if time.monotonic() >= deadline:
+                raise RuntimeError("PICOから応答がありません。boot.pyとmain.pyを確認してください。")
+    
+    def _discard_input(self, deadline):
+        """受信データを途切れる（HANDSHAKE_READ_TIMEOUTの間届かない）まで読み捨てる（deadlineを過ぎたらエラー）"""
+        while True:
+            data = self.serial.read_until(b"\n", MAX_RESPONSE_LENGTH)
+            if not data:
+                return
+            if self.debug:
+                print(f"[DEBUG] Discarded: {data.strip().decode(errors='replace')}")
+            if time.monotonic() >= deadline:
+                raise RuntimeError("PICOから応答がありません。boot.pyとmain.pyを確認してください。")
+    
     def disconnect(self):
         """シリアルポートを切断"""
         if self.serial and self.serial.is_open:
@@ -113,10 +180,38 @@ class PicoSerialLoader:
             print("切断しました")
     
     def send_command(self, command, custom_timeout=None):
-        """コマンドを送信してレスポンスを待つ"""
-        if not self.serial or not self.serial.is_open:
-            raise RuntimeError("シリアルポートが開いていません")
+        """コマンド（文字列、改行コードは自動で統一）を送信してレスポンスを待つ"""
+        self._write_command(command)
+        return self._read_response(custom_timeout)
+    
+    def _send_raw(self, command, custom_timeout=None):
+        """CRLFで終わるコマンド（バイト列）をそのまま送信してレスポンスを待つ"""
+        self._write_raw(command)
+        return self._read_response(custom_timeout)
+    
+    def send_commands_async(self, commands, tags):
+        """
+        連結した複数のコマンド（バイト列）を1回のwrite()で送信し、レスポンスは待たない
+        
+        Args:
+            commands: CRLFで終わるコマンドを連結したもの
+            tags: 各コマンドに対応するdrain_one()で返す値（送信順）
+        """
+        self._write_raw(commands)
+        self.inflight.extend(tags)
+    
+    def drain_one(self, custom_timeout=None):
+        """
+        送信済みコマンドのレスポンスを1つ受信
         
+        Returns:
+            tuple: (send_commands_async()に渡したtag, レスポンス)
+        """
+        response = self._read_response(custom_timeout)
+        return self.inflight.popleft(), response
+    
+    def _write_command(self, command):
+        """コマンドを送信"""
         # 改行コードをCRLFに統一
         if not command.endswith('\r\n'):
             if command.endswith('\n'):
@@ -124,61 +219,71 @@ class PicoSerialLoader:
             else:
                 command += '\r\n'
         
+        self._write_raw(command.encode())
+    
+    def _write_raw(self, command):
+        """CRLFで終わるコマンド（バイト列）をそのまま送信"""
+        if not self.serial or not self.serial.is_open:
+            raise RuntimeError("シリアルポートが開いていません")
+        
         # コマンド送信
         if self.debug:
-            print(f"[DEBUG] Sending: {command.strip()}")
-        
-        self.serial.write(command.encode())
+            for line in bytes(command).splitlines():
+                print(f"[DEBUG] Sending: {line.decode()}")
         
-        # レスポンスを待つ
-        start_time = time.time()
-        response = ""
+        self.serial.write(command)
+    
+    def _read_response(self, custom_timeout=None):
+        """レスポンスを1行受信"""
         timeout = custom_timeout if custom_timeout is not None else RESPONSE_TIMEOUT
         
-        while time.time() - start_time < timeout:
-            if self.serial.in_waiting > 0:
-                data = self.serial.readline()
-                if data:
-                    response = data.decode().strip()
-                    if self.debug:
-                        print(f"[DEBUG] Received: {response}")
-                    break
-            time.sleep(0.01)
+        # 改行を受信するまでドライバ内でブロックする（最大長で打ち切る）
+        # （タイムアウトの変更はポートの再設定を伴うため、値が変わるときだけ行う）
+        if self.serial.timeout != timeout:
+            self.serial.timeout = timeout
+        data = self.serial.read_until(b"\n", MAX_RESPONSE_LENGTH)
         
-        if not response:
+        if not data.endswith(b'\n'):
+            if len(data) >= MAX_RESPONSE_LENGTH:
+                raise RuntimeError(f"レスポンスが長すぎます: {data.decode(errors='replace')}")
             raise TimeoutError(f"レスポンスがタイムアウトしました（{timeout:.1f}秒）")
         
+        # デコードはせずにバイト列のまま返す（エラー時とデバッグ時のみデコード）
+        response = data.strip()
+        if self.debug:
+            print(f"[DEBUG] Received: {response.decode(errors='replace')}")
+        
         return response
     
     def parse_response(self, response):
-        """レスポンスを解析"""
-        parts = response.split(':', 1)
-        if len(parts) != 2:
-            return None, response
+        """レスポンス（バイト列）を解析（エラー時やデバッグ時のみ使用）"""
+        status_end = response.find(b':')
+        if status_end < 0:
+            return None, response.decode(errors='replace')
         
-        status = parts[0]
-        message = parts[1]
+        status = response[:status_end].decode(errors='replace')
+        message = response[status_end + 1:].decode(errors='replace')
         
         return status, message
     
     def ping(self):
         """接続確認"""
-        response = self.send_command("P\n")
-        status, message = self.parse_response(response)
+        start_time = time.time()
+        response = self._send_raw(PING_COMMAND)
+        self.rtt_ms = (time.time() - start_time) * 1000
         
-        if status != "OK" or message != "READY":
-            raise RuntimeError(f"Ping失敗: {response}")
+        if response != RESPONSE_READY:
+            raise RuntimeError(f"Ping失敗: {response.decode(errors='replace')}")
         
         return True
     
     def set_timing(self, pulse_ms):
         """Write Enable期間を設定"""
-        command = f"T:{pulse_ms}\n"
-        response = self.send_command(command)
-        status, message = self.parse_response(response)
+        command = f"T:{pulse_ms}\r\n".encode()
+        response = self._send_raw(command)
         
-        if status != "OK":
-            raise RuntimeError(f"タイミング設定エラー: {response}")
+        if not response.startswith(RESPONSE_OK):
+            raise RuntimeError(f"タイミング設定エラー: {response.decode(errors='replace')}")
         
         if self.debug:
             print(f"[DEBUG] Timing set: pulse={pulse_ms}ms")
@@ -192,56 +297,110 @@ class PicoSerialLoader:
     def adjust_transfer_parameters(self):
         """パルス幅に応じて転送パラメータを調整"""
         
-        # 各バイトの処理時間：WE待機時間×2 + デバッグ出力時間（約10ms）
-        estimated_byte_time = (self.pulse_ms * 2) + 10  # ミリ秒
+        # 各バイトの処理時間：設定待機時間 + WE待機時間×2 + デバッグ出力時間（PICO側のDEBUG有効時のみ、約10ms）
+        estimated_byte_time = BYTE_SETUP_MS + (self.pulse_ms * 2)  # ミリ秒
+        if self.pico_debug:
+            estimated_byte_time += PICO_DEBUG_BYTE_MS
         
         # RESPONSE_TIMEOUT(5秒)の80%以内に収まるようにチャンクサイズを計算
         max_transfer_time = RESPONSE_TIMEOUT * 0.8 * 1000  # 4000ミリ秒
         
-        # 新しいチャンクサイズを計算（最小1、最大128）
-        new_chunk_size = min(128, max(1, int(max_transfer_time / estimated_byte_time)))
+        # 新しいチャンクサイズを計算（最小1、最大MAX_CHUNK_SIZE）
+        new_chunk_size = min(MAX_CHUNK_SIZE, max(1, int(max_transfer_time / estimated_byte_time)))
+        
+        # Writeコマンド全体（W:AAAAAAAA:LLLL:<hex>\r\n）がCDCパケットサイズの倍数に収まるように切り詰める
+        overhead = len(self.build_write_command(0, b''))
+        packets = (overhead + new_chunk_size * 2) // self.cdc_packet_size
+        if packets > 0:
+            new_chunk_size = (packets * self.cdc_packet_size - overhead) // 2
         
         if self.debug:
-            print(f"[DEBUG] Adjusted chunk_size: {new_chunk_size} bytes")
+            print(f"[DEBUG] Adjusted chunk_size: {new_chunk_size} bytes "
+                  f"(command: {len(self.build_write_command(0, bytes(new_chunk_size)))} bytes)")
             print(f"[DEBUG] Estimated time per byte: {estimated_byte_time:.1f}ms")
             print(f"[DEBUG] Max transfer time per chunk: {new_chunk_size * estimated_byte_time:.1f}ms")
 
         self.chunk_size = new_chunk_size
+        
+        # Writeコマンドを組み立てる作業バッファ（最大長のコマンドがMAX_PIPELINE_DEPTH個入る大きさ）
+        self._scratch = bytearray(MAX_PIPELINE_DEPTH * len(self.build_write_command(0, bytes(new_chunk_size))))
+        
+        # 1チャンクの処理中に次のコマンドが届くよう、往復時間を覆える数だけ先に送信する（最小2）
+        chunk_time = new_chunk_size * estimated_byte_time
+        self.window = min(MAX_PIPELINE_DEPTH, max(2, 1 + math.ceil(self.rtt_ms / chunk_time)))
+        
+        if self.debug:
+            print(f"[DEBUG] Pipeline window: {self.window} commands (RTT {self.rtt_ms:.1f}ms)")
+    
+    def build_write_command(self, start_address, data):
+        """Writeコマンド（CRLFで終わるバイト列）を作成"""
+        # データを16進数に変換し、文字列を経由せずにコマンドを組み立てる
+        header = WRITE_HEADER_FORMAT % (start_address, len(data))
+        return header + binascii.hexlify(data).upper() + b"\r\n"
     
     def write_data(self, start_address, data):
         """データを書き込む"""
-        # データを16進数文字列に変換
-        hex_data = ''.join(f'{b:02X}' for b in data)
-        
-        # Writeコマンドを作成
-        command = f"W:{start_address:02X}:{len(data):02X}:{hex_data}\n"
-        
         # 送信（タイムアウトはadjust_transfer_parameters()で設定済み）
-        response = self.send_command(command)
-        status, message = self.parse_response(response)
+        response = self._send_raw(self.build_write_command(start_address, data))
         
-        if status != "OK":
-            raise RuntimeError(f"書き込みエラー: {response}")
+        if not response.startswith(RESPONSE_OK):
+            raise RuntimeError(f"書き込みエラー: {response.decode(errors='replace')}")
         
         return True
     
     def end_transfer(self):
         """転送終了"""
-        response = self.send_command("E\n")
-        status, message = self.parse_response(response)
+        response = self._send_raw(END_COMMAND)
         
-        if status != "OK":
-            raise RuntimeError(f"終了エラー: {response}")
+        if not response.startswith(RESPONSE_OK):
+            raise RuntimeError(f"終了エラー: {response.decode(errors='replace')}")
         
         return True
     
+    def encode_write_commands(self, segments):
+        """
+        連続したデータ領域をチャンクサイズ単位のWriteコマンドに変換
+        
+        Args:
+            segments: (開始アドレス, データ)のリスト
+            
+        Returns:
+            list: (データ長, ヘッダ, 16進数データ)のリスト（16進数データはmemoryviewで参照）
+        """
+        chunk_size = self.chunk_size
+        commands = []
+        for seg_start, buf in segments:
+            # データ領域全体を一度に16進数へ変換し、チャンクごとに切り出す
+            hex_view = memoryview(binascii.hexlify(buf).upper())
+            for offset in range(0, len(buf), chunk_size):
+                length = min(chunk_size, len(buf) - offset)
+                header = WRITE_HEADER_FORMAT % (seg_start + offset, length)
+                commands.append((length, header, hex_view[offset * 2:(offset + length) * 2]))
+        return commands
+    
+    def _fill_write_command(self, pos, header, hex_data):
+        """
+        作業バッファのposの位置にWriteコマンドを組み立てる
+        
+        Returns:
+            int: 組み立てたコマンドの末尾の位置
+        """
+        scratch = self._scratch
+        end = pos + len(header)
+        scratch[pos:end] = header
+        pos, end = end, end + len(hex_data)
+        scratch[pos:end] = hex_data
+        scratch[end:end + 2] = b"\r\n"
+        return end + 2
+    
     def transfer_hex_file(self, hex_file, pulse_ms=None):
         """Intel Hexファイルを転送"""
         # Hexファイルを読み込む
         loader = IntelHexLoader()
         loader.load_file(hex_file)
         
-        print(f"\nHexファイル読み込み完了: {len(loader.memory)} バイト")
+        total_bytes = loader.get_data_size()
+        print(f"\nHexファイル読み込み完了: {total_bytes} バイト")
         
         # メモリマップを表示
         print("\nメモリマップ:")
@@ -262,30 +421,41 @@ class PicoSerialLoader:
         
         # データを転送
         print("\nデータ転送中...")
-        total_bytes = len(loader.memory)
         transferred_bytes = 0
-        
-        # アドレス順にソートして、連続したデータをまとめて送信
-        sorted_addresses = sorted(loader.memory.keys())
-        
-        i = 0
-        while i < len(sorted_addresses):
-            start_addr = sorted_addresses[i]
-            data = [loader.memory[start_addr]]
+        last_print = 0.0  # 最後に進捗を表示した時刻
+        
+        # 送信するWriteコマンドを先に作成（連続したデータ領域をチャンクサイズで分割）
+        commands = self.encode_write_commands(loader.segments)
+        
+        # 前回の転送がエラーで中断した場合に残ったレスポンス待ちのコマンドを捨てる
+        self.inflight.clear()
+        
+        # レスポンスを待たずにwindow個までコマンドを送信し、PICOの書き込み中に次のコマンドを転送する
+        next_command = 0
+        while next_command < len(commands) or self.inflight:
+            free = self.window - len(self.inflight)
+            if next_command < len(commands) and free > 0:
+                # 空いている分のコマンドを作業バッファに連結し、1回のwrite()でまとめて送信
+                batch = commands[next_command:next_command + free]
+                next_command += len(batch)
+                end = 0
+                for length, header, hex_data in batch:
+                    end = self._fill_write_command(end, header, hex_data)
+                self.send_commands_async(memoryview(self._scratch)[:end], [length for length, _, _ in batch])
+                continue
             
-            # 連続したアドレスのデータをまとめる
-            j = i + 1
-            while j < len(sorted_addresses) and len(data) < self.chunk_size:
-                if sorted_addresses[j] == start_addr + len(data):
-                    data.append(loader.memory[sorted_addresses[j]])
-                    j += 1
-                else:
-                    break
+            # 最も古いコマンドのレスポンスを受信
+            length, response = self.drain_one()
+            if not response.startswith(RESPONSE_OK):
+                raise RuntimeError(f"書き込みエラー: {response.decode(errors='replace')}")
             
-            # データを送信
-            self.write_data(start_addr & 0xFF, bytes(data))
+            transferred_bytes += length
             
-            transferred_bytes += len(data)
+            # 表示はPROGRESS_INTERVAL秒に1回まで（最後の100%は必ず表示）
+            now = time.monotonic()
+            if now - last_print < PROGRESS_INTERVAL and transferred_bytes != total_bytes:
+                continue
+            last_print = now
             progress = (transferred_bytes / total_bytes) * 100
             
             # デバッグモードの場合は改行、通常モードは上書き
@@ -293,8 +463,6 @@ class PicoSerialLoader:
                 print(f"転送中... {transferred_bytes}/{total_bytes} バイト ({progress:.1f}%)")
             else:
                 print(f"\r転送中... {transferred_bytes}/{total_bytes} バイト ({progress:.1f}%)", end='', flush=True)
-            
-            i = j
         
         # 通常モードの場合のみ改行（デバッグモードは既に改行されている）
         if not self.debug:
@@ -314,8 +482,12 @@ def main():
     parser.add_argument('hexfile', help='転送するIntel Hexファイル')
     parser.add_argument('-p', '--port', help='シリアルポート（省略時は自動検出）')
     parser.add_argument('-b', '--baudrate', type=int, default=DEFAULT_BAUDRATE,
-                        help=f'ボーレート（デフォルト: {DEFAULT_BAUDRATE}）')
+                        help=f'ボーレート（デフォルト: {DEFAULT_BAUDRATE}、USB CDCでは転送速度に影響しない）')
     parser.add_argument('-d', '--debug', action='store_true', help='デバッグモード')
+    parser.add_argument('--cdc-packet-size', type=int, choices=[64, 512], default=DEFAULT_CDC_PACKET_SIZE,
+                        help=f'USB CDCのパケットサイズ（デフォルト: {DEFAULT_CDC_PACKET_SIZE}）')
+    parser.add_argument('--pico-no-debug', dest='pico_debug', action='store_false',
+                        help='PICO側のmain.pyでDEBUG=Falseにしている場合に指定（チャンクサイズを最大4096バイトまで大きくする）')
     parser.add_argument('--pulse', type=float, metavar='MS',
                         help='Write Enableパルス幅（ミリ秒、0.1-1000）')
     
@@ -333,7 +505,8 @@ def main():
             sys.exit(1)
     
     # ローダーを作成
-    loader = PicoSerialLoader(port=args.port, baudrate=args.baudrate, debug=args.debug)
+    loader = PicoSerialLoader(port=args.port, baudrate=args.baudrate, debug=args.debug,
+                              cdc_packet_size=args.cdc_packet_size, pico_debug=args.pico_debug)
     
     try:
         # 接続